@@ -1,228 +1,406 @@
-import argparse
-import os
-import requests
-import sys
-import time
-from dotenv import load_dotenv
-
-load_dotenv()
-
-class SelogerAPI:
-    def __init__(self, concurrency=1, annonce_details=False, tasks_file=None, max_pages=2):
-        self.api_key = os.environ.get("LOBSTR_API_KEY")
-        if not self.api_key:
-            sys.exit("LOBSTR_API_KEY environment variable not set!")
-        self.headers = {
-            'Authorization': f'Token {self.api_key}',
-            'Content-Type': 'application/json'
-        }
-        self.concurrency = concurrency
-        self.annonce_details = annonce_details
-        self.tasks_file = tasks_file
-        self.max_pages = max_pages
-        self.squid_id = None
-        self.run_id = None
-
-    @staticmethod
-    def get_mime_type(file_path):
-        ext = os.path.splitext(file_path)[1].lower()
-        if ext == '.csv':
-            return 'text/csv'
-        elif ext == '.tsv':
-            return 'text/tab-separated-values'
-        else:
-            sys.exit("Invalid file extension. Valid values are: csv or tsv.")
-
-    def create_squid(self):
-        url = "https://api.lobstr.io/v1/squids/create"
-        payload = {"crawler": "78f5839ee4b97c30e67eec391b907dd0"}
-        print("Creating squid...")
-        resp = requests.post(url, headers=self.headers, json=payload)
-        if not resp.ok:
-            sys.exit(f"Error creating squid: {resp.text}")
-        self.squid_id = resp.json().get("id")
-        if not self.squid_id:
-            sys.exit("Squid ID not found!")
-        print("Squid created with ID:", self.squid_id)
-
-    def update_squid(self):
-        url = f"https://api.lobstr.io/v1/squids/{self.squid_id}"
-        payload = {
-            "concurrency": self.concurrency,
-            "export_unique_results": True,
-            "no_line_breaks": True,
-            "to_complete": False,
-            "params": {
-                "max_pages": self.max_pages,
-                "fill_results_details": {"annonce_details": self.annonce_details}
-            },
-            "accounts": None,
-            "run_notify": "on_success"
-        }
-        print("Updating squid...")
-        resp = requests.post(url, headers=self.headers, json=payload)
-        if not resp.ok:
-            sys.exit(f"Error updating squid: {resp.text}")
-        print("Squid updated.")
-
-    def upload_tasks_file(self):
-        url = f"https://api.lobstr.io/v1/squids/{self.squid_id}/tasks/upload"
-        mime_type = self.get_mime_type(self.tasks_file)
-        try:
-            with open(self.tasks_file, 'rb') as f:
-                files = [
-                    ('file', (os.path.basename(self.tasks_file), f, mime_type))
-                ]
-                resp = requests.post(url, headers={'Authorization': f'Token {self.api_key}'}, files=files)
-        except Exception as e:
-            sys.exit(f"Error opening file: {e}")
-
-        if not resp.ok:
-            sys.exit(f"Error uploading tasks file: {resp.text}")
-        task_upload_id = resp.json().get("task_id")
-        if not task_upload_id:
-            sys.exit("Task upload ID not found in response!")
-        print("Tasks file uploaded. Upload Task ID:", task_upload_id)
-        return task_upload_id
-
-    def poll_task_upload_status(self, task_upload_id):
-        url = f"https://api.lobstr.io/v1/tasks/upload/{task_upload_id}"
-        print("Polling for tasks file upload status:")
-        max_wait = 60
-        interval = 5
-        elapsed = 0
-        while elapsed < max_wait:
-            resp = requests.get(url, headers={'Authorization': f'Token {self.api_key}'})
-            if not resp.ok:
-                sys.exit(f"Error checking upload status: {resp.text}")
-            status_info = resp.json()
-            state = status_info.get("state", "")
-            print(f"Upload state: {state}")
-            if state.upper() == "SUCCESS":
-                print("Tasks file upload completed successfully.")
-                return
-            time.sleep(interval)
-            elapsed += interval
-        sys.exit("Tasks file upload did not complete within expected time.")
-
-    def delete_squid(self):
-        url = f"https://api.lobstr.io/v1/squids/{self.squid_id}"
-        print("No tasks file provided. Deleting squid...")
-        resp = requests.delete(url, headers=self.headers)
-        if not resp.ok:
-            sys.exit(f"Error deleting squid: {resp.text}")
-        print("Squid deleted:", resp.json())
-
-    def start_run(self):
-        url = "https://api.lobstr.io/v1/runs"
-        payload = {"squid": self.squid_id}
-        print("Starting run...")
-        resp = requests.post(url, headers=self.headers, json=payload)
-        if not resp.ok:
-            sys.exit(f"Error starting run: {resp.text}")
-        self.run_id = resp.json().get("id")
-        if not self.run_id:
-            sys.exit("Run ID not found!")
-        print("Run started with ID:", self.run_id)
-
-    def poll_run_progress(self):
-        url = f"https://api.lobstr.io/v1/runs/{self.run_id}/stats"
-        print("Polling for run progress:")
-        while True:
-            resp = requests.get(url, headers=self.headers)
-            if not resp.ok:
-                sys.exit(f"Error retrieving run stats: {resp.text}")
-            data = resp.json()
-            percent_done = data.get("percent_done", "0%")
-            results_done = data.get("results_done", 0)
-            results_total = data.get("results_total", 0)
-            sys.stdout.write(f"\rProgress: {percent_done} ({results_done}/{results_total} results)")
-            sys.stdout.flush()
-            if data.get("is_done"):
-                print("\nRun is complete.")
-                break
-            time.sleep(2)
-
-    def poll_export_status(self):
-        url = f"https://api.lobstr.io/v1/runs/{self.run_id}"
-        print("Polling for export completion (export_done:true):")
-        max_wait = 120
-        interval = 5
-        elapsed = 0
-        while elapsed < max_wait:
-            resp = requests.get(url, headers=self.headers)
-            if not resp.ok:
-                sys.exit(f"Error retrieving run details: {resp.text}")
-            data = resp.json()
-            if data.get("export_done", False):
-                print("Export is complete.\n")
-                print("Run Details:")
-                print("Status:", data.get("status"))
-                print("Done Reason:", data.get("done_reason"))
-                print("Duration:", data.get("duration"))
-                print("Credit Used:", data.get("credit_used"))
-                print("Total Results:", data.get("total_results"))
-                print("Unique Results:", data.get("total_unique_results"))
-                return
-            print("Export not done yet. Waiting...")
-            time.sleep(interval)
-            elapsed += interval
-        sys.exit("Export did not complete within expected time.")
-
-    def get_s3_url(self):
-        url = f"https://api.lobstr.io/v1/runs/{self.run_id}/download"
-        print("Requesting download URL for run results...")
-        resp = requests.get(url, headers=self.headers)
-        if not resp.ok:
-            sys.exit(f"Error requesting download URL: {resp.text}")
-        s3_url = resp.json().get("s3")
-        if not s3_url:
-            sys.exit("S3 URL not found!")
-        print("\nS3 URL for run results:")
-        print(s3_url)
-        return s3_url
-
-    def download_csv(self, s3_url):
-        print("Downloading CSV file from S3 URL...")
-        resp = requests.get(s3_url)
-        if not resp.ok:
-            sys.exit(f"Error downloading CSV file: {resp.text}")
-        filename = "run_results.csv"
-        with open(filename, "wb") as f:
-            f.write(resp.content)
-        print(f"CSV file downloaded and saved as '{filename}'.")
-
-def parse_args():
-    parser = argparse.ArgumentParser(description="Seloger API Script")
-    parser.add_argument("-c", "--concurrency", type=int, default=1,
-                        help="Set the concurrency level for the run (default: 1)")
-    parser.add_argument("-a", "--annonce_details", action="store_true",
-                        help="Include annonce_details (default: False)")
-    parser.add_argument("-l", "--tasks_file", type=str,
-                        help="Path to CSV/TSV file containing tasks to upload")
-    parser.add_argument("-p", "--max_pages", type=int, default=2,
-                        help="Maximum pages for the run (default: 2)")
-    return parser.parse_args()
-
-def main():
-    args = parse_args()
-    api = SelogerAPI(concurrency=args.concurrency, 
-                     annonce_details=args.annonce_details, 
-                     tasks_file=args.tasks_file, 
-                     max_pages=args.max_pages)
-    api.create_squid()
-    api.update_squid()
-    if api.tasks_file:
-        task_upload_id = api.upload_tasks_file()
-        api.poll_task_upload_status(task_upload_id)
-    else:
-        api.delete_squid()
-        sys.exit("No tasks file provided. Exiting.")
-    api.start_run()
-    api.poll_run_progress()
-    api.poll_export_status()
-    s3_url = api.get_s3_url()
-    api.download_csv(s3_url)
-
-if __name__ == "__main__":
-    main()
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import httpx
+import orjson
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_loads = orjson.loads
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+class SelogerAPI:
+    def __init__(self, concurrency=1, annonce_details=False, tasks_file=None, max_pages=2,
+                 webhook_url=None, webhook_port=8765):
+        self.api_key = os.environ.get("LOBSTR_API_KEY")
+        if not self.api_key:
+            sys.exit("LOBSTR_API_KEY environment variable not set!")
+        self._auth_headers = {'Authorization': f'Token {self.api_key}'}
+        self.concurrency = concurrency
+        self.annonce_details = annonce_details
+        self.tasks_file = tasks_file
+        self.max_pages = max_pages
+        self.webhook_url = webhook_url
+        self.webhook_port = webhook_port
+        self.squid_id = None
+        self.run_id = None
+        self._run_url = None
+        self._download_url = None
+        # Fail fast on a bad tasks file: catching it here saves the
+        # create/configure round-trips and the squid cleanup on the error path.
+        if tasks_file:
+            if not os.path.isfile(tasks_file):
+                sys.exit(f"Tasks file not found: {tasks_file}")
+            if os.stat(tasks_file).st_size == 0:
+                sys.exit(f"Tasks file is empty: {tasks_file}")
+        self._upload_basename = os.path.basename(tasks_file) if tasks_file else None
+        self._upload_mime = self.get_mime_type(tasks_file) if tasks_file else None
+        self.session = None
+        self._run_done = asyncio.Event()
+        self._webhook_event = asyncio.Event()
+        self._webhook_runner = None
+
+    async def __aenter__(self):
+        # HTTP/2 multiplexes the polls on one connection and HPACK-compresses
+        # the repeated Authorization header.
+        self.session = httpx.AsyncClient(
+            http2=True,
+            headers=self._auth_headers,
+            limits=httpx.Limits(max_keepalive_connections=10),
+            timeout=httpx.Timeout(30.0)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        if self._webhook_runner:
+            await self._webhook_runner.cleanup()
+        if self.session:
+            await self.session.aclose()
+
+    @staticmethod
+    def get_mime_type(file_path):
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext == '.csv':
+            return 'text/csv'
+        elif ext == '.tsv':
+            return 'text/tab-separated-values'
+        else:
+            sys.exit("Invalid file extension. Valid values are: csv or tsv.")
+
+    def _run_notify(self):
+        if not self.webhook_url:
+            return "on_success"
+        return {"type": "webhook", "url": self.webhook_url.rstrip("/") + "/lobstr-callback"}
+
+    async def start_webhook_server(self):
+        app = web.Application()
+        app.router.add_post("/lobstr-callback", self._handle_webhook)
+        self._webhook_runner = web.AppRunner(app)
+        await self._webhook_runner.setup()
+        site = web.TCPSite(self._webhook_runner, "0.0.0.0", self.webhook_port)
+        await site.start()
+        print(f"Webhook receiver listening on port {self.webhook_port} "
+              f"(public URL: {self._run_notify()['url']})")
+
+    async def _handle_webhook(self, request):
+        try:
+            payload = _loads(await request.read())
+        except ValueError:
+            return web.Response(status=400, text="invalid payload")
+        run_id = payload.get("run") or payload.get("run_id") or payload.get("id")
+        if self.run_id and run_id and run_id != self.run_id:
+            return web.Response(status=400, text="unknown run")
+        self._webhook_event.set()
+        return web.Response()
+
+    async def wait_for_run_completion(self, timeout=600):
+        print("Waiting for run completion webhook...")
+        try:
+            await asyncio.wait_for(self._webhook_event.wait(), timeout)
+            print("Webhook received: run is complete.")
+        except asyncio.TimeoutError:
+            print("No webhook received in time. Checking run state directly...")
+            resp = await self.session.get(self._run_url)
+            if not resp.is_success:
+                sys.exit(f"Error retrieving run details: {resp.text}")
+            data = _loads(resp.content)
+            if not data.get("is_done"):
+                sys.exit("Run did not complete within expected time.")
+            print("Run is complete.")
+        self._run_done.set()
+
+    def _squid_config(self):
+        return {
+            "concurrency": self.concurrency,
+            "export_unique_results": True,
+            "no_line_breaks": True,
+            "to_complete": False,
+            "params": {
+                "max_pages": self.max_pages,
+                "fill_results_details": {"annonce_details": self.annonce_details}
+            },
+            "accounts": None,
+            "run_notify": self._run_notify()
+        }
+
+    async def create_and_configure_squid(self):
+        url = "https://api.lobstr.io/v1/squids/create"
+        payload = {"crawler": "78f5839ee4b97c30e67eec391b907dd0", **self._squid_config()}
+        print("Creating squid...")
+        resp = await self.session.post(url, content=orjson.dumps(payload),
+                                       headers=_JSON_HEADERS)
+        if resp.is_success:
+            self.squid_id = _loads(resp.content).get("id")
+            if not self.squid_id:
+                sys.exit("Squid ID not found!")
+            print("Squid created and configured with ID:", self.squid_id)
+            return
+        if resp.status_code not in (400, 422):
+            sys.exit(f"Error creating squid: {resp.text}")
+        # Creation-time config rejected; fall back to create + update.
+        await self.create_squid()
+        await self.update_squid()
+
+    async def create_squid(self):
+        url = "https://api.lobstr.io/v1/squids/create"
+        payload = {"crawler": "78f5839ee4b97c30e67eec391b907dd0"}
+        print("Creating squid...")
+        resp = await self.session.post(url, content=orjson.dumps(payload),
+                                       headers=_JSON_HEADERS)
+        if not resp.is_success:
+            sys.exit(f"Error creating squid: {resp.text}")
+        self.squid_id = _loads(resp.content).get("id")
+        if not self.squid_id:
+            sys.exit("Squid ID not found!")
+        print("Squid created with ID:", self.squid_id)
+
+    async def update_squid(self):
+        url = f"https://api.lobstr.io/v1/squids/{self.squid_id}"
+        print("Updating squid...")
+        resp = await self.session.post(url, content=orjson.dumps(self._squid_config()),
+                                       headers=_JSON_HEADERS)
+        if not resp.is_success:
+            sys.exit(f"Error updating squid: {resp.text}")
+        print("Squid updated.")
+
+    async def upload_tasks_file(self):
+        url = f"https://api.lobstr.io/v1/squids/{self.squid_id}/tasks/upload"
+        try:
+            f = open(self.tasks_file, 'rb')
+        except OSError as e:
+            sys.exit(f"Error opening file: {e}")
+
+        try:
+            # Passing the open file handle (not f.read()) keeps the
+            # multipart body streaming in chunks, so memory stays constant
+            # regardless of the tasks file size.
+            files = {'file': (self._upload_basename, f, self._upload_mime)}
+            resp = await self.session.post(url, files=files)
+        finally:
+            f.close()
+
+        if not resp.is_success:
+            sys.exit(f"Error uploading tasks file: {resp.text}")
+        task_upload_id = _loads(resp.content).get("task_id")
+
+        if not task_upload_id:
+            sys.exit("Task upload ID not found in response!")
+        print("Tasks file uploaded. Upload Task ID:", task_upload_id)
+        return task_upload_id
+
+    async def _poll(self, url, predicate, error_msg, initial=0.5, max_interval=10, max_wait=120):
+        interval = initial
+        start = time.monotonic()
+        while max_wait is None or time.monotonic() - start < max_wait:
+            resp = await self.session.get(url)
+            if not resp.is_success:
+                sys.exit(f"{error_msg}: {resp.text}")
+            data = _loads(resp.content)
+            retry_after = resp.headers.get("Retry-After")
+            if predicate(data):
+                return data
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    delay = interval
+            else:
+                delay = interval + random.uniform(0, 0.25 * interval)
+            await asyncio.sleep(delay)
+            interval = min(interval * 1.5, max_interval)
+        return None
+
+    async def _prewarm(self, url="https://api.lobstr.io/v1/runs"):
+        # Prime a pooled connection while the upload poll runs, so
+        # start_run's POST doesn't pay for a fresh TLS handshake if the
+        # keep-alive connection was dropped during the wait.
+        try:
+            await self.session.head(url)
+        except httpx.HTTPError:
+            pass
+
+    async def poll_task_upload_status(self, task_upload_id):
+        url = f"https://api.lobstr.io/v1/tasks/upload/{task_upload_id}"
+        print("Polling for tasks file upload status:")
+
+        def upload_done(data):
+            state = data.get("state", "")
+            print(f"Upload state: {state}")
+            return state.upper() == "SUCCESS"
+
+        if await self._poll(url, upload_done, "Error checking upload status", max_wait=60) is None:
+            sys.exit("Tasks file upload did not complete within expected time.")
+        print("Tasks file upload completed successfully.")
+
+    async def delete_squid(self):
+        url = f"https://api.lobstr.io/v1/squids/{self.squid_id}"
+        print("No tasks file provided. Deleting squid...")
+        resp = await self.session.delete(url)
+        if not resp.is_success:
+            sys.exit(f"Error deleting squid: {resp.text}")
+        print("Squid deleted:", _loads(resp.content))
+
+    async def start_run(self):
+        url = "https://api.lobstr.io/v1/runs"
+        payload = {"squid": self.squid_id}
+        print("Starting run...")
+        resp = await self.session.post(url, content=orjson.dumps(payload),
+                                       headers=_JSON_HEADERS)
+        if not resp.is_success:
+            sys.exit(f"Error starting run: {resp.text}")
+        self.run_id = _loads(resp.content).get("id")
+        if not self.run_id:
+            sys.exit("Run ID not found!")
+        self._run_url = f"https://api.lobstr.io/v1/runs/{self.run_id}"
+        self._download_url = f"{self._run_url}/download"
+        print("Run started with ID:", self.run_id)
+
+    @staticmethod
+    def _print_run_summary(data):
+        print("Export is complete.\n")
+        print("Run Details:")
+        print("Status:", data.get("status"))
+        print("Done Reason:", data.get("done_reason"))
+        print("Duration:", data.get("duration"))
+        print("Credit Used:", data.get("credit_used"))
+        print("Total Results:", data.get("total_results"))
+        print("Unique Results:", data.get("total_unique_results"))
+
+    async def poll_run(self):
+        # The run record carries both the progress fields and export_done,
+        # so one loop on /runs/{id} covers progress and export in a single
+        # request per tick.
+        print("Polling for run progress:")
+        run_done_at = None
+        last_line = None
+        last_flush = 0.0
+
+        def export_ready(data):
+            nonlocal run_done_at, last_line, last_flush
+            percent_done = data.get("percent_done", "0%")
+            results_done = data.get("results_done", 0)
+            results_total = data.get("results_total", 0)
+            line = f"Progress: {percent_done} ({results_done}/{results_total} results)"
+            # Only redraw on change, and flush at most every 500ms, so a
+            # sub-second poll interval doesn't turn into terminal spam.
+            if line != last_line:
+                sys.stdout.write(f"\x1b[2K\r{line}")
+                last_line = line
+            now = time.monotonic()
+            if now - last_flush > 0.5:
+                sys.stdout.flush()
+                last_flush = now
+            if data.get("export_done", False):
+                return True
+            if data.get("is_done") and run_done_at is None:
+                run_done_at = time.monotonic()
+            if run_done_at is not None and time.monotonic() - run_done_at > 120:
+                sys.exit("\nExport did not complete within expected time.")
+            return False
+
+        data = await self._poll(self._run_url, export_ready, "Error retrieving run details",
+                                max_interval=5, max_wait=None)
+        print("\nRun is complete.")
+        self._print_run_summary(data)
+
+    async def poll_export_status(self):
+        # Export only completes after the run itself, so the 120s budget
+        # starts once the completion webhook (or its fallback) fires.
+        await self._run_done.wait()
+        print("Polling for export completion (export_done:true):")
+
+        def export_done(data):
+            if not data.get("export_done", False):
+                print("Export not done yet. Waiting...")
+                return False
+            return True
+
+        data = await self._poll(self._run_url, export_done, "Error retrieving run details", max_wait=120)
+        if data is None:
+            sys.exit("Export did not complete within expected time.")
+        self._print_run_summary(data)
+
+    async def get_s3_url(self):
+        print("Requesting download URL for run results...")
+        resp = await self.session.get(self._download_url)
+        if not resp.is_success:
+            sys.exit(f"Error requesting download URL: {resp.text}")
+        s3_url = _loads(resp.content).get("s3")
+        if not s3_url:
+            sys.exit("S3 URL not found!")
+        print("\nS3 URL for run results:")
+        print(s3_url)
+        return s3_url
+
+    async def download_csv(self, s3_url):
+        print("Downloading CSV file from S3 URL...")
+        filename = "run_results.csv"
+        # The presigned URL must not carry the token header, so use a bare client.
+        async with httpx.AsyncClient(timeout=httpx.Timeout(30.0)) as s3_client:
+            async with s3_client.stream("GET", s3_url) as resp:
+                if not resp.is_success:
+                    await resp.aread()
+                    sys.exit(f"Error downloading CSV file: {resp.text}")
+                with open(filename, "wb") as f:
+                    async for chunk in resp.aiter_bytes(1 << 20):
+                        f.write(chunk)
+        print(f"CSV file downloaded and saved as '{filename}'.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Seloger API Script")
+    parser.add_argument("-c", "--concurrency", type=int, default=1,
+                        help="Set the concurrency level for the run (default: 1)")
+    parser.add_argument("-a", "--annonce_details", action="store_true",
+                        help="Include annonce_details (default: False)")
+    parser.add_argument("-l", "--tasks_file", type=str,
+                        help="Path to CSV/TSV file containing tasks to upload")
+    parser.add_argument("-p", "--max_pages", type=int, default=2,
+                        help="Maximum pages for the run (default: 2)")
+    parser.add_argument("-w", "--webhook_url", type=str,
+                        help="Public base URL reaching this machine (e.g. an ngrok tunnel); "
+                             "enables webhook notification instead of progress polling")
+    parser.add_argument("--webhook_port", type=int, default=8765,
+                        help="Local port for the webhook receiver (default: 8765)")
+    return parser.parse_args()
+
+async def async_main(args):
+    async with SelogerAPI(concurrency=args.concurrency,
+                          annonce_details=args.annonce_details,
+                          tasks_file=args.tasks_file,
+                          max_pages=args.max_pages,
+                          webhook_url=args.webhook_url,
+                          webhook_port=args.webhook_port) as api:
+        if api.webhook_url:
+            await api.start_webhook_server()
+        await api.create_and_configure_squid()
+        if api.tasks_file:
+            task_upload_id = await api.upload_tasks_file()
+            await asyncio.gather(api.poll_task_upload_status(task_upload_id),
+                                 api._prewarm())
+        else:
+            await api.delete_squid()
+            sys.exit("No tasks file provided. Exiting.")
+        await api.start_run()
+        if api.webhook_url:
+            await api.wait_for_run_completion()
+            await api.poll_export_status()
+        else:
+            await api.poll_run()
+        s3_url = await api.get_s3_url()
+        await api.download_csv(s3_url)
+
+def main():
+    args = parse_args()
+    asyncio.run(async_main(args))
+
+if __name__ == "__main__":
+    main()